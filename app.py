@@ -5,28 +5,30 @@
 # - LLM 프롬프트 강화: 효과성/효율성 언급 금지, 오직 Risk(논란/법/윤리/규정/차별/문화·종교 감수성/환경/오해소지)만.
 # - 추가 안전장치: 모델 응답에서 성과/효율성 관련 문구를 자동 필터링(sanitize)하여 UI 표시.
 
-import os, re, json, base64, math, html
+import os, re, json, base64, math, html, asyncio, hashlib, time
+from dataclasses import dataclass
+from io import BytesIO, StringIO
 from typing import Optional, List, Tuple
 import streamlit as st
+import diskcache
+from PIL import Image, ImageOps
+
+from llm_json import JsonObjectScanner, json_dumps_pretty, parse_json
 
 # Gemini SDK
 from google import genai
 from google.genai import types
 
 # ========== 0) API KEY ==========
+_ENV_RE = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=(.*)$", re.M)
+
 def _parse_env_file(path: str) -> dict:
-    out = {}
     try:
         with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                s = line.strip()
-                if not s or s.startswith("#") or "=" not in s:
-                    continue
-                k, v = s.split("=", 1)
-                out[k.strip()] = v.strip().strip('"').strip("'")
+            text = f.read()
     except FileNotFoundError:
-        pass
-    return out
+        return {}
+    return {k: v.strip().strip('"').strip("'") for k, v in _ENV_RE.findall(text)}
 
 def load_api_key() -> Optional[str]:
     if hasattr(st, "secrets"):
@@ -55,83 +57,295 @@ def get_client(api_key: str):
 
 client = get_client(API_KEY)
 
-def _gen_config():
+# 동일 입력(모델·프롬프트·이미지) 재분석 시 Gemini 왕복을 생략하는 응답 캐시
+RESPONSE_CACHE_DIR = ".risk_cache"
+RESPONSE_CACHE_TTL = 3600
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache() -> Optional[diskcache.Cache]:
+    try:
+        return diskcache.Cache(RESPONSE_CACHE_DIR)
+    except Exception:
+        # 읽기 전용/잠긴 작업 디렉터리 등 → 캐시 없이 동작
+        return None
+
+response_cache = get_response_cache()
+
+def _response_key(model: str, prompt: str, image_hashes: Tuple[str, ...] = ()) -> str:
+    # 이미지 순서는 응답의 index와 연결되므로 정렬하지 않는다
+    payload = json.dumps([model, prompt, list(image_hashes)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    if response_cache is None:
+        return None
+    try:
+        return response_cache.get(key)
+    except Exception:
+        return None
+
+def _cache_put(key: str, text: str) -> None:
+    # 호출 측에서 파싱/후처리에 성공한 응답만 저장한다
+    if response_cache is None:
+        return
+    try:
+        response_cache.set(key, text, expire=RESPONSE_CACHE_TTL)
+    except Exception:
+        pass
+
+@dataclass(frozen=True)
+class ImagePart:
+    part: types.Part
+    sha256: str
+
+# 최악의 생성 지연 상한 (텍스트+이미지 통합 응답 기준으로 여유 있게)
+MAX_OUTPUT_TOKENS = 4096
+
+def _gen_config(cached_content: Optional[str] = None):
     return types.GenerateContentConfig(
         response_modalities=["TEXT"],
         response_mime_type="application/json",
         thinking_config=types.ThinkingConfig(thinking_budget=0),
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        cached_content=cached_content,
     )
 
-def call_gemini_text(prompt: str, model: str) -> str:
-    try:
-        cfg = _gen_config()
-        resp = client.models.generate_content(model=model, contents=prompt, config=cfg)
-        return (getattr(resp, "text", "") or "").strip()
-    except Exception as e:
-        return f"Gemini Error: {e}"
+# 정적 시스템 프롬프트는 Gemini 명시적 컨텍스트 캐시에 올려두고 동적 컨텍스트만 전송
+PROMPT_CACHE_TTL_SEC = 3600
+PROMPT_CACHE_RETRY_SEC = 300  # 일시적 생성 실패 후 재시도 간격
+# 모델별 명시적 캐시 최소 토큰 수 (미달 프롬프트는 캐시 생성 자체를 시도하지 않음)
+PROMPT_CACHE_MIN_TOKENS = {"gemini-2.5-flash": 1024, "gemini-2.5-pro": 4096}
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache_registry() -> dict:
+    # (model, system_prompt) -> (cached_content 이름 또는 None, 유효 시각)
+    return {}
+
+prompt_cache_registry = get_prompt_cache_registry()
 
-def call_gemini_mm(prompt: str, image_parts: List[types.Part], model: str) -> str:
+def _create_prompt_cache(model: str, system_prompt: str) -> Tuple[Optional[str], float]:
     try:
-        cfg = _gen_config()
-        parts = [types.Part.from_text(text=prompt)] + (image_parts or [])
-        resp = client.models.generate_content(model=model, contents=parts, config=cfg)
-        return (getattr(resp, "text", "") or "").strip()
-    except Exception as e:
-        return f"Gemini Error: {e}"
-
-def parse_json_or_fail(raw: str, fail_title: str) -> dict:
+        n = client.models.count_tokens(model=model, contents=system_prompt).total_tokens or 0
+        if n < PROMPT_CACHE_MIN_TOKENS.get(model, 4096):
+            return None, math.inf  # 정적 프롬프트라 결과가 바뀌지 않음
+        cache = client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=[types.Part.from_text(text=system_prompt)])],
+                ttl=f"{PROMPT_CACHE_TTL_SEC}s",
+            ),
+        )
+        return cache.name, PROMPT_CACHE_TTL_SEC - 300
+    except Exception:
+        # 권한/네트워크 등 일시적 실패 → 기존(전체 프롬프트) 경로 사용 후 잠시 뒤 재시도
+        return None, PROMPT_CACHE_RETRY_SEC
+
+def get_prompt_cache(model: str, system_prompt: str) -> Optional[str]:
+    """블로킹 네트워크 호출이 있으므로 이벤트 루프에서는 asyncio.to_thread로 호출"""
+    now = time.time()
+    hit = prompt_cache_registry.get((model, system_prompt))
+    if hit and hit[1] > now:
+        return hit[0]
+    name, ttl = _create_prompt_cache(model, system_prompt)
+    prompt_cache_registry[(model, system_prompt)] = (name, now + ttl)
+    return name
+
+def _stream_text(model: str, contents: list, cfg: types.GenerateContentConfig) -> str:
+    buf = StringIO()
+    scanner = JsonObjectScanner()
+    stream = client.models.generate_content_stream(model=model, contents=contents, config=cfg)
+    try:
+        for chunk in stream:
+            piece = getattr(chunk, "text", "") or ""
+            buf.write(piece)
+            # 새 청크만 이어서 스캔, 첫 JSON 객체가 닫히면 남은 토큰을 기다리지 않고 종료
+            if scanner.feed(piece):
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    return buf.getvalue().strip()
+
+def _generate_once(
+    model: str,
+    system_prompt: str,
+    ctx: str,
+    images: List[types.Part],
+    cached_content: Optional[str],
+) -> str:
+    if cached_content:
+        try:
+            return _stream_text(model, [types.Part.from_text(text=ctx)] + images, _gen_config(cached_content))
+        except Exception:
+            pass  # 캐시 만료/삭제 시 전체 프롬프트로 재시도
+    parts = [types.Part.from_text(text=system_prompt + "\n\n" + ctx)] + images
+    return _stream_text(model, parts, _gen_config())
+
+def _generate(
+    model: str,
+    system_prompt: str,
+    ctx: str,
+    image_parts: List[ImagePart],
+    cached_content: Optional[str],
+    file_refs: dict,
+) -> str:
+    images = [_model_image_part(ip, file_refs) for ip in image_parts]
     try:
-        s = raw.find("{")
-        e = raw.rfind("}")
-        data = json.loads(raw[s : e + 1]) if s != -1 and e != -1 and e > s else None
+        return _generate_once(model, system_prompt, ctx, images, cached_content)
     except Exception:
-        data = None
-    if not data:
-        st.error(f"{fail_title} — LLM JSON 파싱 실패")
-        with st.expander("LLM 원문 보기"):
-            st.code(raw)
-        st.stop()
-    return data
+        stale = [ip.sha256 for ip, img in zip(image_parts, images) if img is not ip.part]
+        if not stale:
+            raise
+        # 파일 참조가 실린 요청이 실패하면 참조를 버리고 인라인 이미지로 한 번만 재시도
+        for sha in stale:
+            file_refs.pop(sha, None)
+        return _generate_once(model, system_prompt, ctx, [ip.part for ip in image_parts], cached_content)
+
+async def run_risk_calls(
+    kind: str, ctx: str, image_parts: List[ImagePart], model: str, file_refs: Optional[dict] = None
+) -> Tuple[str, Optional[dict], Optional[dict]]:
+    """kind: "text"(텍스트만) / "image"(이미지만) / "combined"(텍스트·이미지 단일 멀티모달 호출).
+    네트워크 호출과 파싱/후처리는 워커 스레드에서 실행된다. 호출 측(asyncio.run)은 전체 완료까지 대기한다."""
+    system_prompt = RISK_PROMPTS[kind]
+    key = _response_key(model, system_prompt + "\n\n" + ctx, tuple(ip.sha256 for ip in image_parts))
+    raw = _cache_get(key)
+    from_cache = bool(raw)
+    if not from_cache:
+        cached_content = await asyncio.to_thread(get_prompt_cache, model, system_prompt)
+        try:
+            # 공유(cache_resource) 클라이언트의 비동기 커넥션은 이벤트 루프에 묶이므로,
+            # asyncio.run마다 새 루프가 생기는 Streamlit에서는 동기 클라이언트를 워커 스레드로 실행
+            raw = await asyncio.to_thread(
+                _generate,
+                model,
+                system_prompt,
+                ctx,
+                image_parts if kind != "text" else [],
+                cached_content,
+                {} if file_refs is None else file_refs,
+            )
+        except Exception as e:
+            raw = f"Gemini Error: {e}"
+    text_risk, image_risk = await asyncio.to_thread(process_risk, raw, kind)
+    # 잘린/산문 응답이나 한쪽이 빠진 통합 응답은 캐시하지 않아 재시도로 복구 가능
+    ok = (text_risk is not None or kind == "image") and (image_risk is not None or kind == "text")
+    if ok and not from_cache:
+        _cache_put(key, raw)
+    return raw, text_risk, image_risk
+
+def show_parse_failure(raw: str, fail_title: str):
+    st.error(f"{fail_title} — LLM JSON 파싱 실패")
+    with st.expander("LLM 원문 보기"):
+        st.code(raw)
+    st.stop()
+
+def split_combined_risk(data: dict) -> Tuple[Optional[dict], Optional[dict]]:
+    """통합 응답 {text_risk, image_risk}를 두 결과로 분리"""
+    t = data.get("text_risk")
+    i = data.get("image_risk")
+    return (t if isinstance(t, dict) else None, i if isinstance(i, dict) else None)
 
 # ========== 2) Upload/Util ==========
-def to_image_part(up) -> Optional[types.Part]:
+# 업로드 바이트 기반 st.cache_data는 세션 간 공유되므로 항목 수/수명 제한
+DATA_CACHE_MAX_ENTRIES = 16
+DATA_CACHE_TTL_SEC = 3600
+MODEL_IMAGE_MAX_SIDE = 1536
+MODEL_IMAGE_JPEG_QUALITY = 85
+
+@st.cache_data(show_spinner=False, max_entries=DATA_CACHE_MAX_ENTRIES, ttl=DATA_CACHE_TTL_SEC)
+def _downscale_for_model(data: bytes, mime: str) -> Tuple[bytes, str]:
+    """모델 전송용으로 축소 + JPEG 재인코딩 (실패 시 원본 그대로)"""
+    try:
+        with Image.open(BytesIO(data)) as src:
+            # 브라우저(오버레이)는 EXIF 회전을 반영하므로 픽셀도 같은 방향으로 맞춤
+            rotated = src.getexif().get(0x0112, 1) != 1  # Orientation 태그
+            im = ImageOps.exif_transpose(src)
+            if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+                rgba = im.convert("RGBA")
+                img = Image.new("RGB", rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel("A"))
+            else:
+                img = im.convert("RGB")
+        img.thumbnail((MODEL_IMAGE_MAX_SIDE, MODEL_IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=MODEL_IMAGE_JPEG_QUALITY, optimize=True)
+        out = buf.getvalue()
+    except Exception:
+        return data, mime
+    # 회전된 이미지는 원본(EXIF 의존)으로 되돌리지 않음
+    return (out, "image/jpeg") if rotated or len(out) < len(data) else (data, mime)
+
+# 큰 이미지는 응답 캐시 미스 시에만 Files API로 1회 업로드 후 URI로 참조 (세션 내 재분석 시 재전송 없음)
+FILE_UPLOAD_THRESHOLD = 200_000
+FILE_REF_DEFAULT_TTL_SEC = 47 * 3600  # Files API 보관 기간(48시간)보다 짧게
+
+def _model_image_part(ip: ImagePart, file_refs: dict) -> types.Part:
+    """워커 스레드에서 호출: 큰 인라인 이미지는 Files API 참조로 교체 (실패 시 인라인 유지)"""
+    blob = ip.part.inline_data
+    if blob is None or len(blob.data or b"") <= FILE_UPLOAD_THRESHOLD:
+        return ip.part
+    ref = file_refs.get(ip.sha256)
+    now = time.time()
+    if ref and ref["expires_at"] > now:
+        return types.Part.from_uri(file_uri=ref["uri"], mime_type=ref["mime_type"])
+    try:
+        f = client.files.upload(file=BytesIO(blob.data), config=types.UploadFileConfig(mime_type=blob.mime_type))
+    except Exception:
+        return ip.part
+    mime = f.mime_type or blob.mime_type
+    exp = getattr(f, "expiration_time", None)
+    file_refs[ip.sha256] = {
+        "uri": f.uri,
+        "mime_type": mime,
+        "expires_at": exp.timestamp() - 600 if exp else now + FILE_REF_DEFAULT_TTL_SEC,
+    }
+    return types.Part.from_uri(file_uri=f.uri, mime_type=mime)
+
+def to_image_part(up) -> Optional[ImagePart]:
+    # 미리보기/오버레이는 uploaded_to_data_uri로 원본 화질 유지, 모델에는 축소본 전송
     if not up:
         return None
     try:
         data = up.read()
         up.seek(0)
-        mime = up.type or "application/octet-stream"
-        return types.Part.from_bytes(data=data, mime_type=mime)
+        data, mime = _downscale_for_model(data, up.type or "application/octet-stream")
+        return ImagePart(
+            part=types.Part.from_bytes(data=data, mime_type=mime),
+            sha256=hashlib.sha256(data).hexdigest(),
+        )
     except Exception:
         return None
 
+@st.cache_data(show_spinner=False, max_entries=DATA_CACHE_MAX_ENTRIES, ttl=DATA_CACHE_TTL_SEC)
+def _encode_data_uri(data: bytes, mime: str) -> str:
+    b64 = base64.b64encode(data).decode("utf-8")
+    return f"data:{mime};base64,{b64}"
+
 def uploaded_to_data_uri(up) -> Optional[str]:
     if not up:
         return None
     try:
         data = up.read()
         up.seek(0)
-        mime = up.type or "image/png"
-        b64 = base64.b64encode(data).decode("utf-8")
-        return f"data:{mime};base64,{b64}"
+        return _encode_data_uri(data, up.type or "image/png")
     except Exception:
         return None
 
-def esc(s: str) -> str:
-    s = str(s or "")
-    return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+_ESC_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
 
-def attr_esc(s: str) -> str:
-    return esc(s).replace('"', "&quot;").replace("'", "&#39;")
+def esc(s: str) -> str:
+    return str(s or "").translate(_ESC_TABLE)
 
 CIRCLED_RANGE = r"[\u2460-\u2473\u24F5-\u24FE\u2776-\u277F]"
+_CIRCLED_RE = re.compile(CIRCLED_RANGE)
+_MULTIWS_RE = re.compile(r"\s{2,}")
 
 def strip_circled(text: str) -> str:
     if not text:
         return ""
-    t = re.sub(CIRCLED_RANGE, "", str(text))
-    t = re.sub(r"\s{2,}", " ", t).strip()
-    return t
+    t = _CIRCLED_RE.sub("", str(text))
+    return _MULTIWS_RE.sub(" ", t).strip()
 
 # ===== 성과/효율 언급 제거 필터 =====
 PERF_KEYWORDS = [
@@ -168,12 +382,14 @@ PERF_KEYWORDS = [
     "재방문",
 ]
 
+# 키워드 전체를 하나의 정규식으로 미리 컴파일 (대소문자 무시, 긴 키워드 우선)
+PERF_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(PERF_KEYWORDS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+
 def _looks_performance(line: str) -> bool:
-    low = (line or "").lower()
-    for kw in PERF_KEYWORDS:
-        if kw.lower() in low:
-            return True
-    return False
+    return bool(PERF_RE.search(line or ""))
 
 def sanitize_lines(lines: List[str]) -> List[str]:
     # 성과/효율 관련 문장을 제거하고, 모두 제거되면 Risk 관점의 안전 코멘트 추가
@@ -192,7 +408,8 @@ def sanitize_lines(lines: List[str]) -> List[str]:
     return outs
 
 # ========== 3) Prompts (안전도: 높을수록 안전, 'Risk'만 평가) ==========
-TEXT_RISK_PROMPT = """
+# 텍스트/이미지 평가 지침과 JSON 스키마를 분리해 두고, 세 프롬프트(text/image/combined)를 모두 여기서 조립
+TEXT_RISK_INSTRUCTIONS = """
 당신은 글로벌 마케팅 거버넌스 'Risk' 심사관이다.
 여기서 'Risk'란 **논란이나 큰 문제가 될 수 있는 요소**를 뜻한다.
 예: 법적·규정 위반 가능성, 윤리/차별/혐오, 정치·종교·문화 감수성 침해, 환경/지속가능성 침해, 잘못된 주장/오해 유발 등.
@@ -202,21 +419,9 @@ TEXT_RISK_PROMPT = """
 
 입력 텍스트의 **안전도**를 정치·문화·환경·사회 4축으로 각 0~25점(높을수록 안전) 평가하라.
 각 축: score(0~25), why(25점이어도 Risk 관점 코멘트), edits(완화/제거 조치), checks(필요 점검).
-JSON ONLY:
-{
-  "country":"",
-  "core_dimensions":[
-    {"name":"Political","score":0,"why":[""],"edits":[""],"checks":[""]},
-    {"name":"Cultural","score":0,"why":[""],"edits":[""],"checks":[""]},
-    {"name":"Environmental","score":0,"why":[""],"edits":[""],"checks":[""]},
-    {"name":"Social","score":0,"why":[""],"edits":[""],"checks":[""]}
-  ],
-  "text_feedback":{"flags":[{"span":"","issues":[""],"edits":[""]}]}
-}
-주의: 번호/원형숫자 기호는 넣지 말라. 성과/효율 관련 언급 금지.
 """
 
-IMAGE_RISK_PROMPT = """
+IMAGE_RISK_INSTRUCTIONS = """
 당신은 글로벌 마케팅 거버넌스 'Risk' 심사관이다.
 'Risk'는 **논란이나 큰 문제가 될 수 있는 요소**로 한정한다(법/윤리/차별/정치·종교·문화 감수성/환경/오해 소지).
 ⚠️ 금지: 클릭/전환/CTR/매출/브랜딩 효과 등 **마케팅 성과·효율성** 언급·평가·제안.
@@ -225,23 +430,57 @@ IMAGE_RISK_PROMPT = """
 각 축: score/why/edits/checks. 각 이미지 index(1부터) notes와 **Risk가 존재하는 영역만** 핫스팟(0~1 좌표) 제공.
 핫스팟에는 가능하면 severity(매우 위험/위험/주의)를 포함하라. edits는 **Risk 완화/제거 조치**로만 작성.
 
-JSON ONLY:
-{
-  "country":"",
-  "core_dimensions":[
+"""
+
+RISK_DIMENSIONS_SCHEMA = """  "core_dimensions":[
     {"name":"Political","score":0,"why":[""],"edits":[""],"checks":[""]},
     {"name":"Cultural","score":0,"why":[""],"edits":[""],"checks":[""]},
     {"name":"Environmental","score":0,"why":[""],"edits":[""],"checks":[""]},
     {"name":"Social","score":0,"why":[""],"edits":[""],"checks":[""]}
-  ],
-  "image_feedback":[
-    {"index":1,"notes":"","hotspots":[
-      {"shape":"circle","cx":0.65,"cy":0.42,"r":0.08,"label":"","severity":"매우 위험","risks":[""],"suggested_edits":[""]}
-    ]}
-  ]
+  ],"""
+
+TEXT_RISK_SCHEMA = (
+    "{\n"
+    '  "country":"",\n'
+    f"{RISK_DIMENSIONS_SCHEMA}\n"
+    '  "text_feedback":{"flags":[{"span":"","issues":[""],"edits":[""]}]}\n'
+    "}"
+)
+
+IMAGE_RISK_SCHEMA = (
+    "{\n"
+    '  "country":"",\n'
+    f"{RISK_DIMENSIONS_SCHEMA}\n"
+    '  "image_feedback":[\n'
+    '    {"index":1,"notes":"","hotspots":[\n'
+    '      {"shape":"circle","cx":0.65,"cy":0.42,"r":0.08,"label":"","severity":"매우 위험","risks":[""],"suggested_edits":[""]}\n'
+    "    ]}\n"
+    "  ]\n"
+    "}"
+)
+
+RISK_PROMPT_FOOTER = "주의: 번호/원형숫자 기호는 넣지 말라. 성과/효율 관련 언급 금지.\n"
+
+TEXT_RISK_PROMPT = f"{TEXT_RISK_INSTRUCTIONS}JSON ONLY:\n{TEXT_RISK_SCHEMA}\n{RISK_PROMPT_FOOTER}"
+
+IMAGE_RISK_PROMPT = f"{IMAGE_RISK_INSTRUCTIONS}JSON ONLY:\n{IMAGE_RISK_SCHEMA}\n{RISK_PROMPT_FOOTER}"
+
+# 텍스트·이미지 지침을 그대로 이어 붙이고 두 스키마를 하나의 {text_risk, image_risk} 루트 아래에 둔다
+COMBINED_RISK_PROMPT = (
+    "\n입력 텍스트와 업로드된 Key Visual을 **각각 따로** 평가하여 "
+    "[text_risk] 지침의 결과는 text_risk에, [image_risk] 지침의 결과는 image_risk에 담아라.\n"
+    f"\n[text_risk]{TEXT_RISK_INSTRUCTIONS}"
+    f"\n[image_risk]{IMAGE_RISK_INSTRUCTIONS}"
+    "JSON ONLY:\n"
+    f'{{\n"text_risk":{TEXT_RISK_SCHEMA},\n"image_risk":{IMAGE_RISK_SCHEMA}\n}}\n'
+    f"{RISK_PROMPT_FOOTER}"
+)
+
+RISK_PROMPTS = {
+    "text": TEXT_RISK_PROMPT,
+    "image": IMAGE_RISK_PROMPT,
+    "combined": COMBINED_RISK_PROMPT,
 }
-주의: 번호/원형숫자 기호는 넣지 말라. 성과/효율 관련 언급 금지.
-"""
 
 # ========== 4) Styles ==========
 CARD_CSS = """
@@ -315,15 +554,17 @@ LEVELS = [
     (0, 5, "매우 위험"),
 ]
 
+DIM_ORDER = ["Political", "Cultural", "Environmental", "Social"]
+
+# 점수(0~25) → 등급/색상 조회표 (LEVELS에서 1회 생성)
+LEVEL_LUT = [next(name for lo, hi, name in LEVELS if lo <= s <= hi) for s in range(26)]
+COLOR_LUT = [PALETTE[name] for name in LEVEL_LUT]
+
 def level_of(score: int) -> str:
-    s = max(0, min(25, int(score)))
-    for lo, hi, name in LEVELS:
-        if lo <= s <= hi:
-            return name
-    return "—"
+    return LEVEL_LUT[max(0, min(25, int(score)))]
 
 def level_color(score: int) -> str:
-    return PALETTE.get(level_of(score), "#6B7280")
+    return COLOR_LUT[max(0, min(25, int(score)))]
 
 def severity_rank(level: str) -> int:
     order = {"매우 안전": 0, "안전": 1, "주의": 2, "위험": 3, "매우 위험": 4}
@@ -432,17 +673,42 @@ def _merge(a: dict, b: dict) -> dict:
         out["severity"] = b["severity"]
     return out
 
+HOTSPOT_GRID = 10  # 0.1 해상도 공간 해시
+HOTSPOT_CENTER_DIST = 0.12
+
+def _grid_cells(b, pad: float = 0.0):
+    def cell(v):
+        return max(0, min(HOTSPOT_GRID - 1, int(math.floor(v * HOTSPOT_GRID))))
+
+    # 음수 w/h·r로 뒤집힌 bbox도 실제 범위(중심 포함)를 덮도록 정규화
+    x1, x2 = min(b[0], b[2]), max(b[0], b[2])
+    y1, y2 = min(b[1], b[3]), max(b[1], b[3])
+    for gx in range(cell(x1 - pad), cell(x2 + pad) + 1):
+        for gy in range(cell(y1 - pad), cell(y2 + pad) + 1):
+            yield (gx, gy)
+
 def dedupe_hotspots(hotspots: list) -> list:
     hs = [h for h in hotspots or [] if isinstance(h, dict)]
-    hs_sorted = sorted(hs, key=lambda h: _area(_bbox(h)), reverse=True)
-    kept = []
-    for h in hs_sorted:
-        b = _bbox(h)
+    bboxes = [_bbox(h) for h in hs]
+    order = sorted(range(len(hs)), key=lambda j: _area(bboxes[j]), reverse=True)
+    kept, kept_boxes = [], []
+    # 보관된 핫스팟을 bbox가 걸치는 모든 셀에 등록 → 겹치거나(IoU>0) 중심이
+    # HOTSPOT_CENTER_DIST 이내인 후보는 반드시 주변 셀에서 조회된다
+    # nan/inf 좌표는 버킷에 넣을 수 없으므로 기존처럼 전체 비교 대상으로 취급
+    grid, unbucketed = {}, []
+    for j in order:
+        h, b = hs[j], bboxes[j]
+        if all(math.isfinite(v) for v in b):
+            cands = set(unbucketed)
+            for c in _grid_cells(b, pad=HOTSPOT_CENTER_DIST):
+                cands.update(grid.get(c, ()))
+        else:
+            cands = range(len(kept))
         merged = False
-        for i, k in enumerate(kept):
-            bk = _bbox(k)
-            if _iou(b, bk) > 0.55 or _centerdist(b, bk) < 0.12:
-                kept[i] = _merge(k, h)
+        for i in sorted(cands):  # 기존과 동일하게 먼저 보관된 항목에 병합
+            bk = kept_boxes[i]
+            if _iou(b, bk) > 0.55 or _centerdist(b, bk) < HOTSPOT_CENTER_DIST:
+                kept[i] = _merge(kept[i], h)
                 merged = True
                 break
         if not merged:
@@ -454,7 +720,14 @@ def dedupe_hotspots(hotspots: list) -> list:
                         hh[key] = max(0.0, min(1.0, v))
                     except Exception:
                         pass
+            bk = _bbox(hh)
+            if all(math.isfinite(v) for v in bk):
+                for c in _grid_cells(bk):
+                    grid.setdefault(c, []).append(len(kept))
+            else:
+                unbucketed.append(len(kept))
             kept.append(hh)
+            kept_boxes.append(bk)
     return kept[:12]
 
 def _color_class_from_severity(h: dict) -> str:
@@ -472,22 +745,23 @@ def make_kv_overlay_html(img_src: str, hotspots: list, alpha: float = 0.20) -> s
     shapes = []
     for h in hs:
         shape = (h.get("shape") or "circle").lower()
-        label = strip_circled(h.get("label") or "")
+        label = esc(strip_circled(h.get("label") or ""))  # <title>은 텍스트 노드 → esc로 충분
         klass = _color_class_from_severity(h)
+        # 0~1 좌표를 viewBox(0~1000) 정수로 변환해 소수 포맷팅 생략
         if shape == "rect":
-            x = float(h.get("x", 0)) * 1000
-            y = float(h.get("y", 0)) * 1000
-            w = float(h.get("w", 0)) * 1000
-            ht = float(h.get("h", 0)) * 1000
+            x = int(round(float(h.get("x", 0)) * 1000))
+            y = int(round(float(h.get("y", 0)) * 1000))
+            w = int(round(float(h.get("w", 0)) * 1000))
+            ht = int(round(float(h.get("h", 0)) * 1000))
             shapes.append(
-                f'<rect class="kv-hot {klass}" x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{ht:.1f}"><title>{attr_esc(label)}</title></rect>'
+                f'<rect class="kv-hot {klass}" x="{x}" y="{y}" width="{w}" height="{ht}"><title>{label}</title></rect>'
             )
         else:
-            cx = float(h.get("cx", 0.5)) * 1000
-            cy = float(h.get("cy", 0.5)) * 1000
-            r = float(h.get("r", 0.08)) * 1000
+            cx = int(round(float(h.get("cx", 0.5)) * 1000))
+            cy = int(round(float(h.get("cy", 0.5)) * 1000))
+            r = int(round(float(h.get("r", 0.08)) * 1000))
             shapes.append(
-                f'<circle class="kv-hot {klass}" cx="{cx:.1f}" cy="{cy:.1f}" r="{r:.1f}"><title>{attr_esc(label)}</title></circle>'
+                f'<circle class="kv-hot {klass}" cx="{cx}" cy="{cy}" r="{r}"><title>{label}</title></circle>'
             )
     svg = (
         f'<svg class="kv-svg" viewBox="0 0 1000 1000" preserveAspectRatio="none" style="--alpha:{alpha}">'
@@ -508,6 +782,75 @@ def make_kv_overlay_html(img_src: str, hotspots: list, alpha: float = 0.20) -> s
         "</div>"
     )
 
+# ===== 응답 후처리 (UI 호출 없음 → 워커 스레드에서 실행 가능) =====
+def _sanitize_dim_items(dims: List[dict]) -> List[dict]:
+    # 성과/효율 언급 제거
+    out = []
+    for d in dims or []:
+        dd = dict(d)
+        dd["why"] = sanitize_lines(d.get("why") or [])
+        dd["edits"] = sanitize_lines(d.get("edits") or [])
+        dd["checks"] = sanitize_lines(d.get("checks") or [])
+        out.append(dd)
+    return out
+
+def _postprocess_text_risk(risk: dict) -> None:
+    risk["core_dimensions"] = _sanitize_dim_items(risk.get("core_dimensions") or [])
+    tfb = risk.get("text_feedback") or {}
+    flags = []
+    for f in tfb.get("flags") or []:
+        ff = dict(f)
+        ff["issues"] = sanitize_lines(f.get("issues") or [])
+        ff["edits"] = sanitize_lines(f.get("edits") or [])
+        flags.append(ff)
+    risk["text_feedback"] = {"flags": flags}
+
+def _postprocess_image_risk(risk: dict) -> None:
+    risk["core_dimensions"] = _sanitize_dim_items(risk.get("core_dimensions") or [])
+    feedback = []
+    for it in risk.get("image_feedback") or []:
+        if not isinstance(it, dict):
+            continue
+        ii = dict(it)
+        ii["hotspots"] = dedupe_hotspots(it.get("hotspots") or [])
+        feedback.append(ii)
+    risk["image_feedback"] = feedback
+
+def process_risk(raw: str, kind: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """parse_json → _sanitize_dim_items → dedupe_hotspots. (text_risk, image_risk), 실패한 쪽은 None"""
+    data = parse_json(raw)
+    if not data:
+        return None, None
+    if kind == "combined":
+        text_risk, image_risk = split_combined_risk(data)
+    elif kind == "image":
+        text_risk, image_risk = None, data
+    else:
+        text_risk, image_risk = data, None
+    if text_risk is not None:
+        _postprocess_text_risk(text_risk)
+    if image_risk is not None:
+        _postprocess_image_risk(image_risk)
+    return text_risk, image_risk
+
+def synthetic_safe_risk(country: str, reason: str, feedback_key: str) -> dict:
+    """LLM 호출 없이 모든 축 25점으로 채운 결과 (이미지/텍스트 미제공)"""
+    feedback = {"flags": []} if feedback_key == "text_feedback" else []
+    return {
+        "country": country,
+        "core_dimensions": [
+            {
+                "name": name,
+                "score": 25,
+                "why": [f"{reason} — 해당 축에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
+                "edits": ["유지 권장"],
+                "checks": ["—"],
+            }
+            for name in DIM_ORDER
+        ],
+        feedback_key: feedback,
+    }
+
 # ========== 7) UI ==========
 st.set_page_config(page_title="Creative Risk Auditor2", page_icon="⚠️", layout="wide")
 st.markdown(CARD_CSS, unsafe_allow_html=True)
@@ -537,8 +880,6 @@ imgs = st.file_uploader(
 
 # sample01.png 자동 첨부 + 썸네일 미리보기
 try:
-    from io import BytesIO
-
     default_imgs = []
     if os.path.exists("sample01.png"):
         with open("sample01.png", "rb") as _f:
@@ -584,6 +925,35 @@ def status_chip_html(score: int) -> str:
         f"<span class='score-small'>{score}/25</span>"
     )
 
+def render_tiles(dims_map: dict) -> str:
+    """세부 평가 타일 그리드 HTML (dims_map은 이미 sanitize된 축별 결과)"""
+    parts = ["<div class='risk-grid'>"]
+    for name in DIM_ORDER:
+        d = dims_map.get(
+            name,
+            {
+                "name": name,
+                "score": 25,
+                "why": [f"{name} 축: 현재 기준에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
+                "edits": ["유지 권장"],
+                "checks": ["—"],
+            },
+        )
+        score = int(d.get("score", 25))
+        why = d.get("why") or []
+        edits = d.get("edits") or []
+        parts.append(f"<div class='risk-tile'><h5>{esc(name)}</h5>")
+        parts.append(f"<div class='status-line'>{status_chip_html(score)}</div>")
+        parts.append("<div class='anno'><b>위험 요소</b><ul>")
+        parts.extend(f"<li><b>{esc(x)}</b></li>" if i == 0 else f"<li>{esc(x)}</li>" for i, x in enumerate(why[:3]))
+        parts.append("</ul></div><div class='anno'><b>수정 제안(리스크 완화)</b><ul>")
+        parts.extend(
+            f"<li><b>{esc(x)}</b></li>" if i == 0 else f"<li>{esc(x)}</li>" for i, x in enumerate(edits[:3])
+        )
+        parts.append("</ul></div></div>")
+    parts.append("</div>")
+    return "".join(parts)
+
 # --- Caption highlight helpers ---
 def _extract_spans_from_flags(flags: List[dict]) -> List[str]:
     spans = []
@@ -599,14 +969,14 @@ def _extract_spans_from_flags(flags: List[dict]) -> List[str]:
     spans = [s for s in {s for s in spans} if len(s) >= 2]
     return sorted(spans, key=len, reverse=True)
 
-def _find_all_ranges(text: str, needle: str) -> List[tuple]:
-    ranges = []
-    if not needle:
-        return ranges
-    pattern = re.compile(re.escape(needle), re.IGNORECASE)
-    for m in pattern.finditer(text):
-        ranges.append((m.start(), m.end()))
-    return ranges
+def _find_all_ranges(text: str, needles: List[str]) -> List[tuple]:
+    """모든 needle의 (겹침 포함) 등장 위치를 정규식 1회 순회로 수집"""
+    if not text or not needles:
+        return []
+    # 전방탐색(lookahead)으로 매 위치에서 가장 긴 needle을 잡아 겹치는 매치도 누락하지 않음
+    alts = "|".join(re.escape(n) for n in sorted(needles, key=len, reverse=True))
+    pattern = re.compile(f"(?=({alts}))", re.IGNORECASE)
+    return [(m.start(), m.start() + len(m.group(1))) for m in pattern.finditer(text)]
 
 def _merge_ranges(ranges: List[tuple]) -> List[tuple]:
     if not ranges:
@@ -624,10 +994,7 @@ def _merge_ranges(ranges: List[tuple]) -> List[tuple]:
 def highlight_caption(text: str, flags: List[dict]) -> str:
     original = text or ""
     spans = _extract_spans_from_flags(flags)
-    all_ranges = []
-    for sp in spans:
-        all_ranges += _find_all_ranges(original, sp)
-    all_ranges = _merge_ranges(all_ranges)
+    all_ranges = _merge_ranges(_find_all_ranges(original, spans))
 
     if not all_ranges:
         return f"<div class='caption-strong'>{html.escape(original)}</div>"
@@ -662,84 +1029,38 @@ if go:
                 image_parts.append(p)
             data_uris.append(uploaded_to_data_uri(up))
 
-    # 텍스트 Risk 평가
-    text_ctx = (
-        f"[국가/지역]\n{country}\n"
-        f"[산업/카테고리]\n{sector or '(미지정)'}\n"
-        f"[텍스트]\n{copy_txt.strip() or '(제공 없음)'}"
-    )
-    with st.spinner("카피라이트(캡션) Risk 평가 중…"):
-        text_raw = call_gemini_text(TEXT_RISK_PROMPT + "\n\n" + text_ctx, model=model)
-        text_risk = parse_json_or_fail(text_raw, "텍스트 Risk 평가")
-
-    # 이미지 Risk 평가
-    if image_parts:
-        img_ctx = (
-            f"[국가/지역]\n{country}\n"
-            f"[산업/카테고리]\n{sector or '(미지정)'}\n"
-            "[이미지] 업로드 순서 기준 1부터."
-        )
-        with st.spinner("Key Visual Risk 평가 중…"):
-            image_raw = call_gemini_mm(IMAGE_RISK_PROMPT + "\n\n" + img_ctx, image_parts, model=model)
-            image_risk = parse_json_or_fail(image_raw, "이미지 Risk 평가")
-    else:
-        image_risk = {
-            "country": country,
-            "core_dimensions": [
-                {
-                    "name": "Political",
-                    "score": 25,
-                    "why": ["이미지 미제공 — 해당 축에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                    "edits": ["유지 권장"],
-                    "checks": ["—"],
-                },
-                {
-                    "name": "Cultural",
-                    "score": 25,
-                    "why": ["이미지 미제공 — 해당 축에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                    "edits": ["유지 권장"],
-                    "checks": ["—"],
-                },
-                {
-                    "name": "Environmental",
-                    "score": 25,
-                    "why": ["이미지 미제공 — 해당 축에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                    "edits": ["유지 권장"],
-                    "checks": ["—"],
-                },
-                {
-                    "name": "Social",
-                    "score": 25,
-                    "why": ["이미지 미제공 — 해당 축에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                    "edits": ["유지 권장"],
-                    "checks": ["—"],
-                },
-            ],
-            "image_feedback": [],
-        }
-
-    # 성과/효율 언급 제거(후처리)
-    def _sanitize_dim_items(dims: List[dict]) -> List[dict]:
-        out = []
-        for d in dims or []:
-            dd = dict(d)
-            dd["why"] = sanitize_lines(d.get("why") or [])
-            dd["edits"] = sanitize_lines(d.get("edits") or [])
-            dd["checks"] = sanitize_lines(d.get("checks") or [])
-            out.append(dd)
-        return out
-
-    text_risk["core_dimensions"] = _sanitize_dim_items(text_risk.get("core_dimensions") or [])
-    image_risk["core_dimensions"] = _sanitize_dim_items(image_risk.get("core_dimensions") or [])
-
-    tfb = text_risk.get("text_feedback") or {}
-    flags = []
-    for f in tfb.get("flags") or []:
-        ff = dict(f)
-        ff["issues"] = sanitize_lines(f.get("issues") or [])
-        ff["edits"] = sanitize_lines(f.get("edits") or [])
-        flags.append(ff)
-    text_risk["text_feedback"] = {"flags": flags}
+    # 텍스트/이미지 Risk 평가 (이미지가 있으면 단일 멀티모달 호출, 빈 텍스트는 생략)
+    skip_text = not (copy_txt or "").strip()  # 빈 카피만 평가 생략
+    kind = ("image" if skip_text else "combined") if image_parts else "text"
+    text_risk = image_risk = None
+    if kind != "text" or not skip_text:
+        ctx_lines = [f"[국가/지역]\n{country}", f"[산업/카테고리]\n{sector or '(미지정)'}"]
+        if kind != "image":
+            ctx_lines.append(f"[텍스트]\n{copy_txt.strip() or '(제공 없음)'}")
+        if kind != "text":
+            ctx_lines.append("[이미지] 업로드 순서 기준 1부터.")
+        spinner_msg, fail_title = {
+            "text": ("카피라이트(캡션) Risk 평가 중…", "텍스트 Risk 평가"),
+            "image": ("Key Visual Risk 평가 중…", "이미지 Risk 평가"),
+            "combined": ("카피라이트(캡션) · Key Visual Risk 평가 중…", "텍스트·이미지 Risk 평가"),
+        }[kind]
+        with st.spinner(spinner_msg):
+            raw, text_risk, image_risk = asyncio.run(
+                run_risk_calls(
+                    kind,
+                    "\n".join(ctx_lines),
+                    image_parts,
+                    model=model,
+                    file_refs=st.session_state.setdefault("file_refs", {}),
+                )
+            )
+        if (text_risk is None and kind != "image") or (image_risk is None and kind != "text"):
+            show_parse_failure(raw, fail_title)
+    if skip_text:
+        st.caption("(텍스트 분석 생략: 입력 없음)")
+        text_risk = synthetic_safe_risk(country, "텍스트 미제공", "text_feedback")
+    if not image_parts:
+        image_risk = synthetic_safe_risk(country, "이미지 미제공", "image_feedback")
 
     # 종합 결과
     core_t = text_risk.get("core_dimensions") or []
@@ -765,11 +1086,10 @@ if go:
         for it in imgs_feedback[:3]:
             idx = int(it.get("index", 1))
             notes = strip_circled((it.get("notes", "") or "").strip())
-            hotspots_all = dedupe_hotspots(it.get("hotspots") or [])
-            hotspots = [h for h in hotspots_all if any((h.get("risks") or []))]
+            hotspots = [h for h in it.get("hotspots") or [] if any((h.get("risks") or []))]
             img_src = None
-            if imgs and 1 <= idx <= len(imgs):
-                img_src = uploaded_to_data_uri(imgs[idx - 1])
+            if 1 <= idx <= len(data_uris):
+                img_src = data_uris[idx - 1]  # 이미지 준비 단계에서 인코딩한 URI 재사용
             if img_src and hotspots:
                 html_overlay = make_kv_overlay_html(img_src, hotspots, alpha=0.20)
                 st.markdown(f"<div class='subcard'>{html_overlay}</div>", unsafe_allow_html=True)
@@ -780,39 +1100,8 @@ if go:
     # Key Visual 세부 평가 내용
     st.markdown("<div class='card'><h4>Key Visual 세부 평가 내용</h4>", unsafe_allow_html=True)
     st.markdown(legend_html(), unsafe_allow_html=True)
-    order = ["Political", "Cultural", "Environmental", "Social"]
     imap = {d.get("name"): d for d in (image_risk.get("core_dimensions") or [])}
-    tiles = []
-    for name in order:
-        d = imap.get(
-            name,
-            {
-                "name": name,
-                "score": 25,
-                "why": [f"{name} 축: 현재 기준에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                "edits": ["유지 권장"],
-                "checks": ["—"],
-            },
-        )
-        score = int(d.get("score", 25))
-        why = sanitize_lines(d.get("why") or [])
-        edits = sanitize_lines(d.get("edits") or [])
-        chip = status_chip_html(score)
-        why_bold = [f"<b>{esc(why[0])}</b>"] + [esc(x) for x in why[1:2]] + [esc(x) for x in why[2:]]
-        edits_bold = [f"<b>{esc(edits[0])}</b>"] + [esc(x) for x in edits[1:2]] + [esc(x) for x in edits[2:]]
-        inner = (
-            f"<div class='risk-tile'><h5>{esc(name)}</h5>"
-            f"<div class='status-line'>{chip}</div>"
-            "<div class='anno'><b>위험 요소</b><ul>"
-            + "".join([f"<li>{x}</li>" for x in why_bold[:3]])
-            + "</ul></div>"
-            "<div class='anno'><b>수정 제안(리스크 완화)</b><ul>"
-            + "".join([f"<li>{x}</li>" for x in edits_bold[:3]])
-            + "</ul></div>"
-            "</div>"
-        )
-        tiles.append(inner)
-    st.markdown("<div class='risk-grid'>" + "".join(tiles) + "</div>", unsafe_allow_html=True)
+    st.markdown(render_tiles(imap), unsafe_allow_html=True)
     st.markdown("</div>", unsafe_allow_html=True)
 
     # 구분선/여백
@@ -832,44 +1121,14 @@ if go:
     st.markdown("<div class='card'><h4>카피라이트(캡션) 세부 평가 내용</h4>", unsafe_allow_html=True)
     st.markdown(legend_html(), unsafe_allow_html=True)
     tmap = {d.get("name"): d for d in (text_risk.get("core_dimensions") or [])}
-    tiles = []
-    for name in order:
-        d = tmap.get(
-            name,
-            {
-                "name": name,
-                "score": 25,
-                "why": [f"{name} 축: 현재 기준에서 뚜렷한 논란·문제 소지가 확인되지 않습니다."],
-                "edits": ["유지 권장"],
-                "checks": ["—"],
-            },
-        )
-        score = int(d.get("score", 25))
-        why = sanitize_lines(d.get("why") or [])
-        edits = sanitize_lines(d.get("edits") or [])
-        chip = status_chip_html(score)
-        why_bold = [f"<b>{esc(why[0])}</b>"] + [esc(x) for x in why[1:2]] + [esc(x) for x in why[2:]]
-        edits_bold = [f"<b>{esc(edits[0])}</b>"] + [esc(x) for x in edits[1:2]] + [esc(x) for x in edits[2:]]
-        inner = (
-            f"<div class='risk-tile'><h5>{esc(name)}</h5>"
-            f"<div class='status-line'>{chip}</div>"
-            "<div class='anno'><b>위험 요소</b><ul>"
-            + "".join([f"<li>{x}</li>" for x in why_bold[:3]])
-            + "</ul></div>"
-            "<div class='anno'><b>수정 제안(리스크 완화)</b><ul>"
-            + "".join([f"<li>{x}</li>" for x in edits_bold[:3]])
-            + "</ul></div>"
-            "</div>"
-        )
-        tiles.append(inner)
-    st.markdown("<div class='risk-grid'>" + "".join(tiles) + "</div>", unsafe_allow_html=True)
+    st.markdown(render_tiles(tmap), unsafe_allow_html=True)
     st.markdown("</div>", unsafe_allow_html=True)
 
     # 다운로드
     out = {"text_risk": text_risk, "image_risk": image_risk, "overall": overall}
     st.download_button(
         "JSON 결과 다운로드",
-        data=json.dumps(out, ensure_ascii=False, indent=2).encode("utf-8"),
+        data=json_dumps_pretty(out),
         file_name="creative_risk_result.json",
         mime="application/json",
     )
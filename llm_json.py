@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# llm_json.py - LLM 응답에서 JSON 객체를 추출/파싱하는 헬퍼 (Streamlit 비의존)
+
+import json
+from typing import Optional
+
+try:
+    import orjson
+except ImportError:  # 미설치 시 표준 json 사용
+    orjson = None
+
+class JsonObjectScanner:
+    """문자열 리터럴/이스케이프를 고려해 첫 번째 균형 잡힌 {...}의 끝을 찾는 증분 스캐너.
+    상태를 유지하므로 스트리밍 청크를 이어서 넣어도 전체를 다시 훑지 않는다."""
+
+    def __init__(self):
+        self.pos = 0  # 지금까지 소비한 문자 수
+        self.start = -1
+        self.end = -1
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk: str) -> bool:
+        """chunk를 이어서 스캔하고, 첫 객체가 닫혔으면 True"""
+        if self.end != -1:
+            return True
+        base = self.pos
+        self.pos += len(chunk)
+        i = 0
+        if self.start == -1:
+            i = chunk.find("{")
+            if i == -1:
+                return False
+            self.start = base + i
+        for i in range(i, len(chunk)):
+            ch = chunk[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = base + i + 1
+                    return True
+        return False
+
+def extract_first_json_object(raw: str) -> Optional[str]:
+    """첫 번째 균형 잡힌 {...} 구간을 반환 (1회 순회)"""
+    scanner = JsonObjectScanner()
+    return raw[scanner.start : scanner.end] if scanner.feed(raw) else None
+
+def strip_trailing_commas(s: str) -> str:
+    """문자열 리터럴 밖에서 '}' 또는 ']' 바로 앞(공백 무시)의 쉼표만 제거"""
+    out = []
+    in_string = False
+    escaped = False
+    pending = -1  # 문자열 밖 쉼표의 out 내 위치 (다음 비공백 문자를 보고 결정)
+    for ch in s:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch in "}]":
+            if pending != -1:
+                out[pending] = ""
+            pending = -1
+        elif ch == ",":
+            pending = len(out)
+        elif not ch.isspace():
+            pending = -1
+            in_string = ch == '"'
+        out.append(ch)
+    return "".join(out)
+
+def json_loads(s: str):
+    return orjson.loads(s) if orjson else json.loads(s)
+
+def json_dumps_pretty(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def parse_json(raw: str) -> Optional[dict]:
+    obj = extract_first_json_object(raw or "")
+    if not obj:
+        return None
+    try:
+        data = json_loads(obj)
+    except Exception:
+        # 흔한 LLM 출력 오류(후행 쉼표) 보정 후 재시도
+        try:
+            data = json_loads(strip_trailing_commas(obj))
+        except Exception:
+            return None
+    return data if isinstance(data, dict) and data else None
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_json import JsonObjectScanner, extract_first_json_object, parse_json, strip_trailing_commas
+
+def test_extract_ignores_braces_in_strings_and_trailing_text():
+    raw = 'note: {"a":"x}\\"{", "b":{"c":1}} then {"z":2}'
+    assert extract_first_json_object(raw) == '{"a":"x}\\"{", "b":{"c":1}}'
+    assert extract_first_json_object("no json") is None
+    assert extract_first_json_object('{"a":1') is None
+
+def test_scanner_across_chunks():
+    scanner = JsonObjectScanner()
+    chunks = ['pre {"a":"}', '{",', '"b":[1', "]}", " tail"]
+    raw = ""
+    for chunk in chunks:
+        raw += chunk
+        if scanner.feed(chunk):
+            break
+    assert raw[scanner.start : scanner.end] == '{"a":"}{","b":[1]}'
+
+def test_strip_trailing_commas_outside_strings_only():
+    assert strip_trailing_commas('{"a":[1, 2, ], }') == '{"a":[1, 2 ] }'
+    assert strip_trailing_commas('{"s":"a, }", "t":"b,]\\", }"}') == '{"s":"a, }", "t":"b,]\\", }"}'
+
+def test_parse_json_keeps_comma_brace_inside_string_values():
+    assert parse_json('{"s":"a, }", "b":[1,]}') == {"s": "a, }", "b": [1]}
+    assert parse_json('x {"flags":[{"span":"할인, ]", "issues":["i",],},]} y') == {
+        "flags": [{"span": "할인, ]", "issues": ["i"]}]
+    }
+    assert parse_json("Gemini Error: boom") is None